@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+This is an asyncio counterpart of query-based models from database.py.
+
+Queries are described with the same `Query` container and rows are returned as dicts, the same way `Database`
+does it, but connections are taken from a pool of asynchronous connections. This allows many concurrent
+coroutines to share a few connections without threads and without blocking the event loop.
+
+This script requires Python 3.7+ with installed aiopg package to run.
+"""
+
+import asyncio
+import itertools
+import sys
+from pprint import pprint
+
+import aiopg
+
+from database import (
+    DB_HOST, DB_LOGIN, DB_NAME, DB_PASSWORD, DB_PORT,
+    Database, Object, Options, Query, Singleton, UserTablesStats,
+)
+
+
+class AsyncDatabase(Singleton):
+    """ This class is responsible for asynchronous interactions with database.
+    `initialize` coroutine should be awaited before executing queries.
+
+    Asynchronous connections work in autocommit mode, so every query runs in its own transaction. """
+    database = None
+    user = None
+    iter_batch_size = 2000
+
+    _pool = None
+    _cursor_names = itertools.count()
+
+    # Rows are converted to dicts exactly the same way as `Database` does it
+    _get_column_names_from_cursor = Database._get_column_names_from_cursor
+    _populate_rows_with_names = Database._populate_rows_with_names
+
+    async def initialize(self, database, user, password, host=None, port=None,
+                         min_connections=1, max_connections=10):
+        if self._pool is not None:
+            raise RuntimeError('Database connection already exists')
+
+        self._pool = await aiopg.create_pool(
+            database=database,
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            minsize=min_connections,
+            maxsize=max_connections,
+        )
+
+        self.database = database
+        self.user = user
+
+    async def close(self):
+        pool = self._get_pool()
+        self._pool = None
+        pool.close()
+        await pool.wait_closed()
+
+    def get_pool_stats(self):
+        if self._pool is None:
+            return None
+
+        return {
+            'connections': self._pool.size,
+            'idle': self._pool.freesize,
+            'in_use': self._pool.size - self._pool.freesize,
+            'max_connections': self._pool.maxsize,
+        }
+
+    async def execute(self, query):
+        """ Execute query and return number of affected rows. """
+        async with self._get_pool().acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query.query_string, *query.args)
+                return cursor.rowcount
+
+    async def get_one(self, query):
+        async with self._get_pool().acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query.query_string, *query.args)
+                row = await cursor.fetchone()
+
+                if row is None:
+                    return row
+
+                return self._populate_rows_with_names(
+                    rows=[row],
+                    names=self._get_column_names_from_cursor(cursor)
+                )[0]
+
+    async def get_all(self, query):
+        async with self._get_pool().acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query.query_string, *query.args)
+
+                return self._populate_rows_with_names(
+                    rows=await cursor.fetchall(),
+                    names=self._get_column_names_from_cursor(cursor)
+                )
+
+    async def get_iter(self, query, batch_size=None):
+        """ Lazily yield rows of the query fetched from a server-side cursor in batches of `batch_size`.
+        Asynchronous connections can not use named cursors of psycopg2, so cursor is declared explicitly
+        and the connection is held in a transaction until iteration is over. """
+        if batch_size is None:
+            batch_size = self.iter_batch_size
+
+        cursor_name = 'async_database_iter_{}'.format(next(self._cursor_names))
+
+        async with self._get_pool().acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute('BEGIN')
+                try:
+                    await cursor.execute(
+                        'DECLARE {} NO SCROLL CURSOR FOR {}'.format(cursor_name, query.query_string),
+                        *query.args
+                    )
+
+                    names = None
+                    while True:
+                        await cursor.execute('FETCH {:d} FROM {}'.format(batch_size, cursor_name))
+                        rows = await cursor.fetchall()
+                        if not rows:
+                            break
+
+                        if names is None:
+                            names = self._get_column_names_from_cursor(cursor)
+
+                        for row in self._populate_rows_with_names(rows=rows, names=names):
+                            yield row
+                finally:
+                    await cursor.execute('ROLLBACK')
+
+    def _get_pool(self):
+        if self._pool is None:
+            raise RuntimeError('No database connection')
+
+        return self._pool
+
+
+class AsyncOptions(object):
+    """ Asynchronous counterparts of `Options` queries. They return the same `Options` instances. """
+
+    @classmethod
+    async def get_all_options(cls):
+        options_info = await AsyncDatabase().get_all(
+            Query('SELECT * FROM options ORDER BY LOWER(name)')
+        )
+        return [Options(**option_info) for option_info in options_info]
+
+    @classmethod
+    async def iter_all_options(cls, batch_size=None):
+        options_info = AsyncDatabase().get_iter(
+            Query('SELECT * FROM options ORDER BY LOWER(name)'),
+            batch_size=batch_size,
+        )
+        async for option_info in options_info:
+            yield Options(**option_info)
+
+    @classmethod
+    async def get_option(cls, name):
+        option_info = await AsyncDatabase().get_one(
+            Query('SELECT * FROM options WHERE name = %(name)s', name=name)
+        )
+        if option_info:
+            return Options(**option_info)
+
+    @classmethod
+    async def get_options(cls, names):
+        options_info = await AsyncDatabase().get_all(
+            Query('SELECT * FROM options WHERE name = ANY(%(names)s)', names=list(names))
+        )
+        return {
+            option_info['name']: Options(**option_info)
+            for option_info in options_info
+        }
+
+    @classmethod
+    async def add_option(cls, name, value):
+        option_info = await AsyncDatabase().get_one(
+            Query(
+                'INSERT INTO options (name, value) VALUES (%(name)s, %(value)s) RETURNING *',
+                name=name,
+                value=value,
+            )
+        )
+        Options._invalidate_cache([name])
+        return Options(**option_info)
+
+    @classmethod
+    async def update(cls, option, value):
+        option_info = await AsyncDatabase().get_one(
+            Query(
+                'UPDATE options SET value = %(value)s WHERE name = %(name)s RETURNING *',
+                name=option.name,
+                value=value,
+            )
+        )
+        Options._invalidate_cache([option.name])
+        Object.update(option, **option_info)
+
+
+class AsyncUserTablesStats(object):
+    """ Asynchronous counterparts of `UserTablesStats` queries. """
+
+    @classmethod
+    async def get_stats(cls):
+        stats_info = await AsyncDatabase().get_all(
+            Query('SELECT schemaname AS schema, relname AS table,'
+                  ' seq_scan, idx_scan, now() as timestamp FROM pg_stat_user_tables')
+        )
+        return [UserTablesStats(**table_stats) for table_stats in stats_info]
+
+    @classmethod
+    async def iter_stats(cls, batch_size=None):
+        stats_info = AsyncDatabase().get_iter(
+            Query('SELECT schemaname AS schema, relname AS table,'
+                  ' seq_scan, idx_scan, now() as timestamp FROM pg_stat_user_tables'),
+            batch_size=batch_size,
+        )
+        async for table_stats in stats_info:
+            yield UserTablesStats(**table_stats)
+
+
+async def run(argv):
+    # Connect to a database
+    await AsyncDatabase().initialize(user=DB_LOGIN, password=DB_PASSWORD, database=DB_NAME,
+                                     host=DB_HOST, port=DB_PORT, max_connections=4)
+
+    # Create key-value storage, asynchronous connections commit every statement right away
+    await AsyncDatabase().execute(
+        Query('CREATE TABLE options (name TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)')
+    )
+    try:
+        # Add options concurrently
+        added_options = await asyncio.gather(*[
+            AsyncOptions.add_option(name=name, value=value)
+            for name, value in [('first', 'one'), ('second', 'two'), ('third', 'three'), ('forth', 'four')]
+        ])
+        pprint(added_options)
+
+        # Update existing option
+        first_option = await AsyncOptions.get_option('first')
+        await AsyncOptions.update(first_option, value='The One')
+        print(first_option)
+
+        # Stream all available options
+        pprint([option async for option in AsyncOptions.iter_all_options(batch_size=2)])
+
+        # Get user table usage statistics from PostgreSQL predefined view
+        pprint(await AsyncUserTablesStats.get_stats())
+    finally:
+        # Drop previously created table
+        await AsyncDatabase().execute(Query('DROP TABLE options'))
+        await AsyncDatabase().close()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    asyncio.run(run(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
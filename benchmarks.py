@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for techniques used in database.py.
+
+Rows are generated in memory, so no database server is required, except for the `random_coordinates`
+benchmark, which connects to the database configured in database.py. Every benchmark prints time and
+peak memory allocated per `ROWS_COUNT` rows. Run a single benchmark by passing its name, e.g.:
+
+    python benchmarks.py row_formats
+
+This script requires Python 3 with installed psycopg2 and NumPy packages to run.
+"""
+
+import sys
+import timeit
+import tracemalloc
+
+from database import (
+    DB_HOST, DB_LOGIN, DB_NAME, DB_PASSWORD, DB_PORT,
+    Database, Object, Point, RandomCoordinates, slotted_model,
+)
+
+ROWS_COUNT = 100000
+
+
+class BenchmarkModel(Object):
+    primary_key = ('id',)
+
+
+def measure(function):
+    """ Returns time in seconds and peak allocated memory in bytes of a single function call. """
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return min(timeit.repeat(function, number=1, repeat=3)), peak
+
+
+def print_results(title, results):
+    print(title)
+    for name, (seconds, peak) in results:
+        print('  {:<24} {:>8.1f} ms {:>10.1f} KiB'.format(name, seconds * 1000, peak / 1024.0))
+
+
+def benchmark_row_formats():
+    names = ('id', 'name', 'value', 'created')
+    rows = [
+        (index, 'option_{}'.format(index), 'value_{}'.format(index), 1234567890 + index)
+        for index in range(ROWS_COUNT)
+    ]
+
+    def dict_rows_and_models():
+        BenchmarkModel.configure_identity_map()
+        return [
+            BenchmarkModel(**row)
+            for row in Database()._format_rows(rows=rows, names=names, row_format='dict')
+        ]
+
+    def models():
+        BenchmarkModel.configure_identity_map()
+        return Database()._format_rows(rows=rows, names=names, row_format=BenchmarkModel)
+
+    results = [
+        ('dict', measure(lambda: Database()._format_rows(rows=rows, names=names, row_format='dict'))),
+        ('tuple', measure(lambda: Database()._format_rows(rows=rows, names=names, row_format='tuple'))),
+        ('namedtuple', measure(lambda: Database()._format_rows(rows=rows, names=names, row_format='namedtuple'))),
+        ('dict, then model', measure(dict_rows_and_models)),
+        ('model', measure(models)),
+    ]
+    print_results('Row formats, {} rows:'.format(ROWS_COUNT), results)
+
+
+def benchmark_model_memory():
+    names = ('schema', 'table', 'seq_scan', 'idx_scan', 'timestamp')
+    rows = [
+        ('public', 'table_{}'.format(index), index, index * 2, 1234567890.0 + index)
+        for index in range(ROWS_COUNT)
+    ]
+
+    class DictStats(Object):
+        pass
+
+    SlottedStats = slotted_model('SlottedStats', names)
+
+    results = [
+        ('dict-backed', measure(lambda: DictStats.from_rows(names=names, rows=rows))),
+        ('slotted', measure(lambda: SlottedStats.from_rows(names=names, rows=rows))),
+    ]
+    print_results('Model instances, {} rows:'.format(ROWS_COUNT), results)
+
+
+def benchmark_random_coordinates():
+    if Database().database is None:
+        Database().initialize(user=DB_LOGIN, password=DB_PASSWORD, database=DB_NAME, host=DB_HOST, port=DB_PORT)
+
+    point1 = Point(x=-500, y=-500)
+    point2 = Point(x=500, y=500)
+
+    def database_coordinates():
+        coordinates = list(RandomCoordinates.pick_many(point1, point2, count=ROWS_COUNT))
+        Database().rollback()
+        return coordinates
+
+    results = [
+        ('database', measure(database_coordinates)),
+        ('local', measure(lambda: RandomCoordinates.pick_local(point1, point2, count=ROWS_COUNT))),
+    ]
+    print_results('Random coordinates, {} points:'.format(ROWS_COUNT), results)
+
+
+BENCHMARKS = {
+    'row_formats': benchmark_row_formats,
+    'model_memory': benchmark_model_memory,
+    'random_coordinates': benchmark_random_coordinates,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    names = argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
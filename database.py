@@ -9,11 +9,33 @@ subset of ORM features. Just remember that with great power comes great responsi
 This script requires Python 2/3 with installed psycopg2 package to run.
 """
 
+import itertools
+import math
+import re
+import select
 import sys
-from collections import namedtuple
+import threading
+import time
+import traceback
+import warnings
+import weakref
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
 from pprint import pprint
 
-from psycopg2 import connect
+from psycopg2 import DatabaseError, IntegrityError, OperationalError, connect
+from psycopg2.extensions import (
+    STATUS_READY, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR, cursor as Cursor,
+)
+from psycopg2.extras import execute_values
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DB_LOGIN = 'user'
 DB_PASSWORD = 'password'
@@ -21,13 +43,328 @@ DB_NAME = 'database'
 DB_HOST = 'localhost'
 DB_PORT = 5432
 
+try:
+    _text_types = (str, unicode)
+    _integer_types = (int, long)
+except NameError:
+    _text_types = (str,)
+    _integer_types = (int,)
+
+_clock = getattr(time, 'perf_counter', time.time)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+_PREPARABLE_RE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b', re.IGNORECASE)
+_TRANSACTION_CONTROL_RE = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+_RETURNS_ROWS_RE = re.compile(r'\s*(SELECT|VALUES|WITH|TABLE|SHOW|FETCH|EXPLAIN)\b|.*\bRETURNING\b',
+                              re.IGNORECASE | re.DOTALL)
+
+
+def _estimate_size(rows):
+    """ Approximate size of fetched values in bytes. """
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (bytes, bytearray, memoryview, str)):
+                size += len(value)
+            elif value is not None:
+                size += sys.getsizeof(value)
+    return size
+
+
+def _freeze(value):
+    """ Hashable version of query arguments. """
+    if isinstance(value, dict):
+        return tuple(sorted((name, _freeze(item)) for name, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _percentile(sorted_values, percent):
+    index = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(index, 0)]
+
+
+class WeakInstanceMap(object):
+    """ Identity map which does not keep instances alive.
+    An entry disappears as soon as its instance is no longer referenced anywhere else. """
+
+    def __init__(self, stats):
+        self._references = {}
+        self._stats = stats
+
+    def get(self, key, default=None):
+        reference = self._references.get(key)
+        if reference is None:
+            return default
+
+        obj = reference()
+        if obj is None:
+            return default
+        return obj
+
+    def pop(self, key, default=None):
+        obj = self.get(key, default)
+        self._references.pop(key, None)
+        return obj
+
+    def __setitem__(self, key, obj):
+        self._references[key] = weakref.ref(obj, lambda reference: self._discard(key, reference))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return list(self._references.keys())
+
+    def __len__(self):
+        return len(self._references)
+
+    def _discard(self, key, reference):
+        if self._references.get(key) is reference:
+            del self._references[key]
+            self._stats['evictions'] += 1
+
+
+class LRUInstanceMap(object):
+    """ Identity map which keeps at most `size` most recently used instances. """
+
+    def __init__(self, size, stats):
+        if size < 1:
+            raise ValueError('Identity map size should be positive, got {}'.format(size))
+
+        self.size = size
+        self._instances = OrderedDict()
+        self._stats = stats
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            obj = self._instances.pop(key, None)
+            if obj is None:
+                return default
+
+            self._instances[key] = obj
+            return obj
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._instances.pop(key, default)
+
+    def __setitem__(self, key, obj):
+        with self._lock:
+            self._instances.pop(key, None)
+            self._instances[key] = obj
+
+            while len(self._instances) > self.size:
+                self._instances.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def __contains__(self, key):
+        return key in self._instances
+
+    def __len__(self):
+        return len(self._instances)
+
+    def keys(self):
+        with self._lock:
+            return list(self._instances.keys())
+
+
+class TTLCache(object):
+    """ Thread-safe cache of at most `max_size` entries, each of them expires `ttl` seconds after it was set.
+    A read of an expired entry is counted as a stale read and as a miss. """
+
+    def __init__(self, ttl, max_size):
+        if max_size < 1:
+            raise ValueError('Cache size should be positive, got {}'.format(max_size))
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_reads = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at <= _monotonic():
+                del self._entries[key]
+                self.stale_reads += 1
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (_monotonic() + self.ttl, value)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            reads = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / reads if reads else 0.0,
+                'stale_reads': self.stale_reads,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class ResultCache(object):
+    """ Cache of query results limited by their approximate total size in bytes.
+    Entries expire `ttl` seconds after they were set, and are dropped at once when any of their tags is invalidated.
+
+    Every invalidation of a tag increases its generation. Results are set along with generations of their tags
+    taken before the query was run, and are not cached if any of the tags was invalidated meanwhile. """
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._generations = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= _monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return entry[3]
+
+    def get_generations(self, tags):
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def set(self, key, rows, tags, generations=None):
+        size = self._estimate_size(rows)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if generations is not None and generations != tuple(self._generations.get(tag, 0) for tag in tags):
+                # Rows might have been read before the invalidation was committed
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (_monotonic() + self.ttl, size, tags, rows)
+            self._size += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in self._tags.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        _, size, tags, _ = self._entries.pop(key)
+        self._size -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    @staticmethod
+    def _estimate_size(rows):
+        values = []
+        for row in rows:
+            if isinstance(row, dict):
+                values.append(row.values())
+            elif isinstance(row, tuple):
+                values.append(row)
+            elif hasattr(row, '__dict__'):
+                values.append(row.__dict__.values())
+            else:
+                values.append([getattr(row, name, None) for name in type(row).__slots__])
+        return sys.getsizeof(rows) + _estimate_size(values)
+
 
 class Object(object):
     """ Common base class for all database models.
-    If primary_key attribute is set, then constructed instances are the same for identical primary keys. """
+    If primary_key attribute is set, then constructed instances are the same for identical primary keys.
+
+    By default the identity map keeps instances forever. Set `identity_map_mode` to 'weak' to keep only
+    instances referenced elsewhere, or to 'lru' to keep at most `identity_map_size` recently used ones.
+
+    Changes of models with both `primary_key` and `__tablename__` set can be written by a `UnitOfWork`.
+    The table name is not a plain attribute, since models often have a column named `table`. """
+
+    # Subclasses get `__dict__` unless they declare their own slots, see `SlottedObject`
+    __slots__ = ()
 
     _instance_map = None
+    _identity_map_stats = None
     primary_key = None
+    __tablename__ = None
+    identity_map_mode = None
+    identity_map_size = 10000
 
     is_admin = False
 
@@ -35,28 +372,162 @@ class Object(object):
         if cls.primary_key is None:
             return super(Object, cls).__new__(cls)
 
-        if cls._instance_map is None:
-            cls._instance_map = {}
+        instance_map = cls._get_instance_map()
 
         cache_key = tuple(
             kwargs[column]
             for column in cls.primary_key
         )
 
-        if cache_key in cls._instance_map:
-            obj = cls._instance_map[cache_key]
-        else:
+        obj = instance_map.get(cache_key)
+        if obj is None:
+            cls._identity_map_stats['misses'] += 1
             obj = super(Object, cls).__new__(cls)
-            cls._instance_map[cache_key] = obj
+            instance_map[cache_key] = obj
+        else:
+            cls._identity_map_stats['hits'] += 1
 
         return obj
 
+    @classmethod
+    def configure_identity_map(cls, mode=None, size=None):
+        """ Switch the identity map of the model to another mode. Currently mapped instances are forgotten. """
+        if mode not in (None, 'weak', 'lru'):
+            raise ValueError('Unknown identity map mode: {!r}'.format(mode))
+
+        cls.identity_map_mode = mode
+        if size is not None:
+            cls.identity_map_size = size
+        cls._instance_map = None
+
+    @classmethod
+    def get_identity_map_stats(cls):
+        instance_map = cls._get_instance_map()
+        stats = dict(cls._identity_map_stats)
+        stats['size'] = len(instance_map)
+        return stats
+
+    @classmethod
+    def _get_instance_map(cls):
+        # Every model class has its own map and counters, they are never inherited from a parent model
+        instance_map = cls.__dict__.get('_instance_map')
+        if instance_map is not None:
+            return instance_map
+
+        cls._identity_map_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if cls.identity_map_mode is None:
+            instance_map = {}
+        elif cls.identity_map_mode == 'weak':
+            instance_map = WeakInstanceMap(cls._identity_map_stats)
+        elif cls.identity_map_mode == 'lru':
+            instance_map = LRUInstanceMap(cls.identity_map_size, cls._identity_map_stats)
+        else:
+            raise ValueError('Unknown identity map mode: {!r}'.format(cls.identity_map_mode))
+
+        cls._instance_map = instance_map
+        return instance_map
+
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+        if type(self).__tablename__ is not None:
+            _track_loaded((self,))
+
+    def __setattr__(self, name, value):
+        if type(self).__tablename__ is not None:
+            _track_changed(self)
+        super(Object, self).__setattr__(name, value)
+
+    @classmethod
+    def from_rows(cls, names, rows, key_indexes=None):
+        """ Construct models straight from fetched rows and their column names, without intermediate dicts.
+        Positions of primary key columns in rows can be passed as `key_indexes` to avoid looking them up. """
+        if cls.primary_key is None:
+            instance_map = None
+        else:
+            instance_map = cls._get_instance_map()
+            stats = cls._identity_map_stats
+            if key_indexes is None:
+                key_indexes = [names.index(column) for column in cls.primary_key]
+
+        objects = []
+        for row in rows:
+            if instance_map is None:
+                obj = object.__new__(cls)
+            else:
+                cache_key = tuple(row[index] for index in key_indexes)
+                obj = instance_map.get(cache_key)
+                if obj is None:
+                    stats['misses'] += 1
+                    obj = object.__new__(cls)
+                    instance_map[cache_key] = obj
+                else:
+                    stats['hits'] += 1
+
+            obj._update_from_row(names, row)
+            objects.append(obj)
+
+        if instance_map is not None and cls.__tablename__ is not None:
+            _track_loaded(objects)
+        return objects
+
+    @classmethod
+    def _flushed(cls, objects):
+        """ Called after changes of `objects` were written by a unit of work. """
 
     def update(self, **kwargs):
+        if type(self).__tablename__ is not None:
+            _track_changed(self)
         self.__dict__.update(kwargs)
 
+    def _update_from_row(self, names, row):
+        self.__dict__.update(zip(names, row))
+
+    def _get_values(self):
+        return dict(self.__dict__)
+
+    def _get_key(self):
+        return tuple(getattr(self, column) for column in self.primary_key)
+
+
+class SlottedObject(Object):
+    """ Base class for models keeping their columns in `__slots__` instead of `__dict__`.
+    Subclasses should list all columns in `__slots__` or be created with `slotted_model`. """
+
+    __slots__ = ('__weakref__',)
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+        if type(self).__tablename__ is not None:
+            _track_loaded((self,))
+
+    def update(self, **kwargs):
+        if type(self).__tablename__ is not None:
+            _track_changed(self)
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+
+    def _update_from_row(self, names, row):
+        for name, value in zip(names, row):
+            object.__setattr__(self, name, value)
+
+    def _get_values(self):
+        return {
+            name: getattr(self, name)
+            for name in type(self).__slots__
+            if name != '__weakref__' and hasattr(self, name)
+        }
+
+
+def slotted_model(name, columns, primary_key=None, base=SlottedObject, **attributes):
+    """ Create model class named `name` with `columns` kept in slots.
+    Column names can be taken from a query with `Database().get_column_names`. """
+    attributes.update(
+        __slots__=tuple(columns),
+        primary_key=primary_key,
+    )
+    return type(name, (base,), attributes)
+
 
 class Query(object):
     """ Query container. """
@@ -85,6 +556,473 @@ class Query(object):
         return self.query_string % query_args
 
 
+class ReadQuery(Query):
+    """ Container of a query which only reads data, so it can be routed to a read replica. """
+
+
+class Replica(object):
+    """ Read replica of the database with its own pool of autocommit connections.
+    Keeps moving average of query latency and periodically checks how far replication lags behind. """
+
+    latency_weight = 0.2
+
+    def __init__(self, dsn, min_connections, max_connections, timeout=None):
+        self.dsn = dsn
+        self.pool = ConnectionPool(
+            connect=self._connect,
+            min_connections=min_connections,
+            max_connections=max_connections,
+            timeout=timeout,
+        )
+        self.latency = None
+        self.lag = None
+        self.unavailable_until = None
+
+        self._lag_checked_at = None
+
+    def is_available(self, max_lag, check_interval):
+        now = _monotonic()
+        if self.unavailable_until is not None and now < self.unavailable_until:
+            return False
+
+        if max_lag is None:
+            return True
+
+        if self._lag_checked_at is None or now - self._lag_checked_at >= check_interval:
+            self._lag_checked_at = now
+            try:
+                self.lag = self._get_lag()
+            except OperationalError:
+                self.mark_unavailable(check_interval)
+                return False
+
+        return self.lag <= max_lag
+
+    def mark_unavailable(self, period):
+        self.unavailable_until = _monotonic() + period
+
+    def record_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.latency_weight * (seconds - self.latency)
+
+    def _get_lag(self):
+        """ Seconds since the last replayed transaction, or zero if everything received is replayed. """
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0'
+                    ' ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0)'
+                )
+                return float(cursor.fetchone()[0])
+        finally:
+            self.pool.putconn(connection)
+
+    def _connect(self):
+        connection = connect(self.dsn)
+        connection.autocommit = True
+        return connection
+
+
+class PreparedStatementCache(object):
+    """ LRU cache of statements prepared on a single connection.
+    A query is prepared with PREPARE after it was executed `threshold` times and then run with EXECUTE.
+    Least recently used statements are deallocated when there are more than `size` of them.
+
+    Types of parameters are declared from Python types of arguments, the same ones psycopg2 gives to literals
+    of them, so results do not depend on whether a query is prepared. Strings and None are typed by the server
+    from the context, just like literals. Query strings are prepared separately for every set of argument types.
+    Queries without arguments, or with arguments of other types, e.g. tuples, are never prepared, as well as
+    the ones which failed to be prepared once. """
+
+    _statement_names = itertools.count()
+
+    def __init__(self, size, threshold, stats):
+        self.size = size
+        self.threshold = threshold
+        self._statements = OrderedDict()
+        self._uses = OrderedDict()
+        self._unpreparable = set()
+        self._stats = stats
+        self._lock = threading.Lock()
+
+    def execute(self, cursor, query):
+        key = self._get_key(query)
+        if key is None or key in self._unpreparable:
+            cursor.execute(query.query_string, *query.args)
+            return
+
+        with self._lock:
+            statement = self._statements.pop(key, None)
+            if statement is not None:
+                self._statements[key] = statement
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+                if (self._count_use(key) >= self.threshold
+                        and cursor.connection.get_transaction_status() != TRANSACTION_STATUS_INERROR):
+                    statement = self._prepare(cursor, key)
+
+        if statement is None:
+            cursor.execute(query.query_string, *query.args)
+            return
+
+        name, parameters = statement
+        query_args = query.args[0]
+        cursor.execute(
+            'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(parameters))),
+            [query_args[parameter] for parameter in parameters]
+        )
+
+    def _get_key(self, query):
+        """ Return query string with types of its arguments, or None if the query should not be prepared. """
+        if not query.args or not query.args[0] or not _PREPARABLE_RE.match(query.query_string):
+            return None
+        if ';' in query.query_string.rstrip().rstrip(';'):
+            return None
+
+        query_args = query.args[0]
+        if isinstance(query_args, dict):
+            types = tuple(sorted((name, self._get_type(value)) for name, value in query_args.items()))
+            if any(parameter_type is None for _, parameter_type in types):
+                return None
+        else:
+            types = tuple(self._get_type(value) for value in query_args)
+            if None in types:
+                return None
+
+        return query.query_string, types
+
+    @staticmethod
+    def _get_type(value):
+        """ Type of literal psycopg2 makes of the value, 'unknown' if it is typed by the context,
+        or None if the value should not be passed as a parameter. """
+        if value is None or isinstance(value, _text_types):
+            return 'unknown'
+        if isinstance(value, bool):
+            return 'boolean'
+        if isinstance(value, _integer_types):
+            if -2 ** 31 < value < 2 ** 31:
+                return 'integer'
+            if -2 ** 63 < value < 2 ** 63:
+                return 'bigint'
+            return 'numeric'
+        if isinstance(value, float):
+            return 'numeric' if not (math.isnan(value) or math.isinf(value)) else 'double precision'
+        if isinstance(value, Decimal):
+            return 'numeric'
+        if isinstance(value, bytes):
+            return 'bytea'
+        if isinstance(value, datetime):
+            return 'timestamp' if value.tzinfo is None else 'timestamptz'
+        if isinstance(value, date):
+            return 'date'
+        if isinstance(value, dt_time) and value.tzinfo is None:
+            return 'time'
+        if isinstance(value, timedelta):
+            return 'interval'
+        if isinstance(value, list):
+            if not value:
+                return 'unknown'
+            item_types = set(PreparedStatementCache._get_type(item) for item in value)
+            if len(item_types) == 1:
+                item_type = item_types.pop()
+                if item_type == 'unknown' and all(isinstance(item, _text_types) for item in value):
+                    return 'text[]'
+                if item_type in ('integer', 'bigint', 'numeric'):
+                    return item_type + '[]'
+        return None
+
+    def _count_use(self, key):
+        uses = self._uses.pop(key, 0) + 1
+        self._uses[key] = uses
+        while len(self._uses) > self.size * 4:
+            self._uses.popitem(last=False)
+        return uses
+
+    def _prepare(self, cursor, key):
+        while len(self._statements) >= self.size:
+            _, (evicted_name, _) = self._statements.popitem(last=False)
+            cursor.execute('DEALLOCATE {}'.format(evicted_name))
+            self._stats['evictions'] += 1
+
+        query_string, types = key
+        server_query_string, parameters = self._convert_placeholders(query_string)
+        if types and isinstance(types[0], tuple):
+            types = dict(types)
+        name = 'database_statement_{}'.format(next(self._statement_names))
+        self._uses.pop(key, None)
+        try:
+            self._execute_isolated(cursor, 'PREPARE {} ({}) AS {}'.format(
+                name,
+                ', '.join(types[parameter] for parameter in parameters),
+                server_query_string.rstrip().rstrip(';'),
+            ))
+        except (DatabaseError, KeyError, IndexError):
+            self._unpreparable.add(key)
+            self._stats['failures'] += 1
+            return None
+        self._stats['prepares'] += 1
+
+        self._statements[key] = (name, parameters)
+        return name, parameters
+
+    @staticmethod
+    def _execute_isolated(cursor, statement):
+        """ Execute statement within a savepoint, so that its failure does not abort the current transaction.
+        The savepoint is set and released in the same round trip. """
+        if cursor.connection.autocommit:
+            cursor.execute(statement)
+            return
+
+        try:
+            cursor.execute('SAVEPOINT database_prepare; {}; RELEASE SAVEPOINT database_prepare'.format(statement))
+        except DatabaseError:
+            cursor.execute('ROLLBACK TO SAVEPOINT database_prepare; RELEASE SAVEPOINT database_prepare')
+            raise
+
+    @staticmethod
+    def _convert_placeholders(query_string):
+        """ Replace psycopg2 placeholders with $n parameters of PostgreSQL.
+        Returns converted string and list of argument names (or positions) for each parameter. """
+        parameters = []
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%'
+
+            parameter = match.group(1)
+            if parameter is None:
+                parameter = len(parameters)
+            if parameter not in parameters:
+                parameters.append(parameter)
+            return '${}'.format(parameters.index(parameter) + 1)
+
+        return _PLACEHOLDER_RE.sub(replace, query_string), parameters
+
+
+QueryRecord = namedtuple('QueryRecord', ['query_string', 'execute_time', 'fetch_time', 'row_count', 'result_bytes'])
+
+
+class QueryStatsAggregator(object):
+    """ Database hook which aggregates query records by query string.
+    Keeps the latest `samples` timings of every query to report their p50/p95/p99 percentiles. """
+
+    percents = (50, 95, 99)
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            stats = self._queries.get(record.query_string)
+            if stats is None:
+                stats = self._queries[record.query_string] = {
+                    'count': 0,
+                    'rows': 0,
+                    'bytes': 0,
+                    'execute_times': deque(maxlen=self.samples),
+                    'fetch_times': deque(maxlen=self.samples),
+                }
+
+            stats['count'] += 1
+            if record.row_count > 0:
+                stats['rows'] += record.row_count
+            stats['bytes'] += record.result_bytes
+            stats['execute_times'].append(record.execute_time)
+            stats['fetch_times'].append(record.fetch_time)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                query_string: {
+                    'count': stats['count'],
+                    'rows': stats['rows'],
+                    'bytes': stats['bytes'],
+                    'execute_time': self._get_percentiles(stats['execute_times']),
+                    'fetch_time': self._get_percentiles(stats['fetch_times']),
+                }
+                for query_string, stats in self._queries.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+
+    def _get_percentiles(self, times):
+        times = sorted(times)
+        return {
+            'p{}'.format(percent): _percentile(times, percent)
+            for percent in self.percents
+        }
+
+
+class RowLayout(object):
+    """ Column names of query results along with everything derived from them to build rows. """
+
+    def __init__(self, names):
+        self.names = names
+        self._row_class = None
+        self._key_indexes = {}
+
+    @property
+    def row_class(self):
+        if self._row_class is None:
+            self._row_class = namedtuple('Row', self.names, rename=True)
+        return self._row_class
+
+    def get_key_indexes(self, model):
+        key_indexes = self._key_indexes.get(model)
+        if key_indexes is None and model.primary_key is not None:
+            key_indexes = self._key_indexes[model] = [self.names.index(column) for column in model.primary_key]
+        return key_indexes
+
+
+class TrackedCursor(Cursor):
+    """ Cursor which remembers where it was created, used by `Database` in cursors debug mode.
+    Cursors garbage collected without being closed are reported as leaked. """
+
+    def __init__(self, *args, **kwargs):
+        super(TrackedCursor, self).__init__(*args, **kwargs)
+        self.created_at = ''.join(traceback.format_stack()[:-2])
+        Database()._track_cursor(self)
+
+    def close(self):
+        super(TrackedCursor, self).close()
+        Database()._untrack_cursor(self, leaked=False)
+
+    def __del__(self):
+        Database()._untrack_cursor(self, leaked=not self.closed)
+
+
+class UnitOfWork(object):
+    """ Tracks changes of model instances and writes them with batched UPDATE statements on `flush`.
+    While the unit of work is active on the thread, instances of models with `primary_key` and `__tablename__`
+    are tracked when an attribute is first assigned or `update` is called, others may be tracked with `add`.
+    Values of columns are remembered when tracking starts and compared on `flush`, so changes made in place
+    to mutable values are noticed only for tracked instances. Changed instances are grouped by model and set
+    of changed columns, and every group is written with multi-row UPDATEs of `page_size` rows each, casting
+    new values to the types of table columns. See `Database.unit_of_work`. """
+
+    def __init__(self, page_size=None):
+        self.page_size = page_size
+        self._instances = OrderedDict()
+        self._column_types = {}
+
+    def add(self, obj):
+        """ Start tracking `obj`, current values of its columns are treated as unchanged. """
+        model = type(obj)
+        if model.primary_key is None or model.__tablename__ is None:
+            raise ValueError('Model {} needs primary_key and __tablename__ to be tracked'.format(model.__name__))
+
+        key = (model, obj._get_key())
+        if key not in self._instances:
+            self._instances[key] = (obj, obj._get_values())
+
+    def get_dirty(self):
+        """ Return list of (instance, changed column names) pairs. """
+        dirty = []
+        for obj, saved_values in self._instances.values():
+            values = obj._get_values()
+            changed = tuple(sorted(
+                name
+                for name, value in saved_values.items()
+                if name in values and values[name] != value
+            ))
+            if changed:
+                dirty.append((obj, changed))
+        return dirty
+
+    def flush(self):
+        """ Write all changed instances and return their number. """
+        groups = OrderedDict()
+        for obj, changed in self.get_dirty():
+            model = type(obj)
+            for name in changed:
+                if name in model.primary_key:
+                    raise ValueError('Primary key column {!r} of {!r} can not be changed'.format(name, obj))
+            groups.setdefault((model, changed), []).append(obj)
+
+        for (model, changed), objects in groups.items():
+            columns = model.primary_key + changed
+            # Columns of VALUES get types from the first row, which fails for uuid, jsonb, enums and all-NULL columns
+            column_types = self._get_column_types(model.__tablename__)
+            for name in columns:
+                if name not in column_types:
+                    raise ValueError('Table {} has no column {!r}'.format(model.__tablename__, name))
+
+            Database().get_all_values(
+                Query(
+                    'UPDATE {table} AS model SET {assignments} FROM (VALUES %s) AS changes ({columns})'
+                    ' WHERE {condition} RETURNING model.*'.format(
+                        table=model.__tablename__,
+                        assignments=', '.join(
+                            '{0} = CAST(changes.{0} AS {1})'.format(_quote(name), column_types[name])
+                            for name in changed
+                        ),
+                        columns=', '.join(_quote(name) for name in columns),
+                        condition=' AND '.join(
+                            'model.{0} = CAST(changes.{0} AS {1})'.format(_quote(name), column_types[name])
+                            for name in model.primary_key
+                        ),
+                    )
+                ),
+                values=[[getattr(obj, name) for name in columns] for obj in objects],
+                page_size=self.page_size,
+                row_format=model,
+            )
+            self._remember(objects)
+            model._flushed(objects)
+
+        return sum(len(objects) for objects in groups.values())
+
+    def _get_column_types(self, table):
+        column_types = self._column_types.get(table)
+        if column_types is None:
+            column_types = self._column_types[table] = dict(Database().get_all(
+                Query(
+                    'SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute'
+                    ' WHERE attrelid = %(table)s::regclass AND attnum > 0 AND NOT attisdropped',
+                    table=table,
+                ),
+                row_format='tuple',
+            ))
+        return column_types
+
+    def _remember(self, objects):
+        for obj in objects:
+            self._instances[(type(obj), obj._get_key())] = (obj, obj._get_values())
+
+    def _refresh(self, objects):
+        # Reloaded values of tracked instances are the ones stored in the database
+        for obj in objects:
+            key = (type(obj), obj._get_key())
+            if key in self._instances:
+                self._instances[key] = (obj, obj._get_values())
+
+
+def _track_loaded(objects):
+    """ Remember reloaded values of instances tracked by the active unit of work of the current thread. """
+    unit_of_work = getattr(Database._local, 'unit_of_work', None)
+    if unit_of_work is not None and unit_of_work._instances:
+        unit_of_work._refresh(objects)
+
+
+def _track_changed(obj):
+    """ Start tracking `obj` before its attributes are changed, if the current thread has an active unit of work. """
+    unit_of_work = getattr(Database._local, 'unit_of_work', None)
+    if unit_of_work is not None and type(obj).primary_key is not None:
+        unit_of_work.add(obj)
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
 class Singleton(object):
     """ Singleton pattern class """
 
@@ -96,19 +1034,215 @@ class Singleton(object):
         return cls._instance
 
 
+class ConnectionPool(object):
+    """ Thread-safe pool of database connections.
+    Connections are opened lazily up to `max_connections`; when all of them are checked out,
+    `getconn` blocks until another thread returns one with `putconn`. """
+
+    def __init__(self, connect, min_connections, max_connections, timeout=None):
+        if min_connections < 0 or max_connections < 1 or min_connections > max_connections:
+            raise ValueError('Invalid pool size: min={}, max={}'.format(min_connections, max_connections))
+
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._connect = connect
+        self._condition = threading.Condition()
+        self._idle = [connect() for _ in range(min_connections)]
+        self._checked_out = set()
+        self._size = len(self._idle)
+        self._in_use = 0
+
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def getconn(self):
+        waited = None
+
+        with self._condition:
+            started = _clock()
+            while not self._idle and self._size >= self.max_connections:
+                if waited is None:
+                    self.waits += 1
+                waited = _clock() - started
+
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - waited
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self._record_wait(waited)
+                        raise RuntimeError('Timed out waiting for a database connection')
+                self._condition.wait(remaining)
+
+            if waited is not None:
+                self._record_wait(_clock() - started)
+
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                self._size += 1
+            else:
+                self._checked_out.add(connection)
+            self._in_use += 1
+            self.checkouts += 1
+            self.peak_in_use = max(self.peak_in_use, self._in_use)
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._condition.notify()
+                raise
+
+            with self._condition:
+                self._checked_out.add(connection)
+
+        return connection
+
+    def putconn(self, connection, close=False):
+        if close and not connection.closed:
+            connection.close()
+
+        with self._condition:
+            if connection not in self._checked_out:
+                # Checked out before the pool was closed
+                if not connection.closed:
+                    connection.close()
+                return
+
+            self._checked_out.remove(connection)
+            self._in_use -= 1
+            if connection.closed:
+                self._size -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    def closeall(self):
+        """ Close idle connections. """
+        with self._condition:
+            for connection in self._idle:
+                connection.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def close(self):
+        """ Close idle and checked out connections, the latter ones are ignored when they are returned. """
+        with self._condition:
+            self.closeall()
+            for connection in self._checked_out:
+                connection.close()
+            self._size -= len(self._checked_out)
+            self._in_use -= len(self._checked_out)
+            self._checked_out = set()
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'connections': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'peak_in_use': self.peak_in_use,
+                'max_connections': self.max_connections,
+                'saturation': float(self._in_use) / self.max_connections,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+    def _record_wait(self, waited):
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+
 class Database(Singleton):
     """ This class is responsible for interactions with database.
-    `initialize` method should be called before executing queries. """
+    `initialize` method should be called before executing queries.
+
+    If pool sizes are passed to `initialize`, connections are taken from a `ConnectionPool`:
+    in a `transaction` block a thread checks out a connection on its first query and keeps it until the block
+    exits, calls made outside of such blocks are committed and return their connection right away.
+    Otherwise all threads share one connection.
+
+    With `debug_cursors` set, either on the class or by `initialize`, every cursor remembers the stack where
+    it was created. Open cursors and the ones garbage collected without being closed are reported by
+    `get_cursors_report`.
+
+    With positive `prepare_cache_size`, query strings executed at least `prepare_threshold` times on a connection
+    are prepared on the server and are not parsed and planned again. Types of parameters are declared from
+    types of arguments, see `PreparedStatementCache`.
+
+    Hooks added with `add_hook` are called with a `QueryRecord` for every query run by `execute`, `get_one`
+    and `get_all`. Queries are not timed at all while there are no hooks.
+
+    `ReadQuery` queries of `get_one` and `get_all` go to one of `replicas`, chosen either round robin or
+    by the least latency, unless the current thread is in a `transaction` block or has uncommitted changes.
+    Replicas lagging more than `max_replica_lag` seconds or failed recently are skipped, and the primary is used
+    if none is left. Every replica has its own pool of up to `replica_max_connections` connections.
+
+    After `enable_result_cache`, results of `get_all` calls with `cache_tags` are cached by query string and
+    arguments, unless the transaction has uncommitted changes. Every call returns a new list, dict rows are
+    copied, while tuples and model instances are shared. Writes should call `invalidate_cached_results` with
+    tags of the data they change.
+
+    Connections broken by a restart or a failover of the server are replaced on the next query, opening of
+    connections is retried `reconnect_attempts` times with exponentially growing delays. `ReadQuery` queries
+    of `get_one` and `get_all` run outside of transactions are repeated on a new connection. A connection lost
+    with an unfinished transaction is replaced only after `rollback`, since its changes are gone.
+
+    Blocks run with `unit_of_work` write changed attributes of loaded models in batched UPDATEs when they exit.
+
+    Methods returning rows accept `row_format`: 'dict' (default), 'tuple', 'namedtuple' or a model class,
+    whose instances are then constructed straight from fetched rows. """
     database = None
     user = None
+    iter_batch_size = 2000
+    values_page_size = 1000
+    batch_page_size = 100
+    prepare_cache_size = 0
+    prepare_threshold = 5
+    debug_cursors = False
+    leaked_cursors_report_size = 100
+    replica_max_connections = 10
+    reconnect_attempts = 5
+    reconnect_delay = 0.1
+    max_reconnect_delay = 5.0
 
     _connection = None
-
-    def initialize(self, database, user, password, host=None, port=None):
-        if self._connection is not None:
+    _connection_has_writes = False
+    _transaction_number = 0
+    _pool = None
+    _replicas = ()
+    _result_cache = None
+    _prepared_statements = None
+    _hooks = ()
+    _row_layouts = {}
+    row_layouts_cache_size = 1000
+    _local = threading.local()
+    _cursor_names = itertools.count()
+
+    def initialize(self, database, user, password, host=None, port=None,
+                   min_connections=None, max_connections=None, pool_timeout=None,
+                   prepare_cache_size=0, prepare_threshold=5, debug_cursors=None,
+                   replicas=(), replica_selection='round_robin', max_replica_lag=None, replica_check_interval=5.0,
+                   replica_max_connections=None):
+        if replica_selection not in ('round_robin', 'least_latency'):
+            raise ValueError('Unknown replica selection: {!r}'.format(replica_selection))
+        if (self._connection is not None and not self._connection.closed) or self._pool is not None:
             raise RuntimeError('Database connection already exists')
 
-        self._connection = connect(
+        self._connection_params = dict(
             database=database,
             user=user,
             password=password,
@@ -116,79 +1250,948 @@ class Database(Singleton):
             port=port,
         )
 
+        self.prepare_cache_size = prepare_cache_size
+        self.prepare_threshold = prepare_threshold
+        if debug_cursors is not None:
+            self.debug_cursors = debug_cursors
+        self._open_cursors = {}
+        self._leaked_cursors = deque(maxlen=self.leaked_cursors_report_size)
+        self._leaked_cursors_count = 0
+        self._cursors_lock = threading.Lock()
+        self._prepared_statements = weakref.WeakKeyDictionary()
+        self._prepared_statements_lock = threading.Lock()
+        self._prepared_statements_stats = {'hits': 0, 'misses': 0, 'prepares': 0, 'evictions': 0, 'failures': 0}
+        self._reconnect_lock = threading.Lock()
+        self.reconnects = 0
+        self.retried_queries = 0
+
+        if min_connections is None and max_connections is None:
+            self._connection = self._connect()
+        else:
+            if min_connections is None:
+                min_connections = 1
+            if max_connections is None:
+                max_connections = max(min_connections, 1)
+            self._pool = ConnectionPool(
+                connect=self._connect,
+                min_connections=min_connections,
+                max_connections=max_connections,
+                timeout=pool_timeout,
+            )
+
+        if replica_max_connections is not None:
+            self.replica_max_connections = replica_max_connections
+        self.replica_selection = replica_selection
+        self.max_replica_lag = max_replica_lag
+        self.replica_check_interval = replica_check_interval
+        self._replica_numbers = itertools.count()
+        self._replicas = [
+            Replica(
+                dsn=dsn,
+                min_connections=0,
+                max_connections=self.replica_max_connections,
+                timeout=pool_timeout,
+            )
+            for dsn in replicas
+        ]
+
         self.database = database
         self.user = user
 
+    def close(self):
+        """ Close all connections, including the ones checked out by other threads, after that `initialize`
+        can be called again. Other threads should roll back their transactions before the next query. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+            self._local.connection = None
+        elif self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+        for replica in self._replicas:
+            replica.pool.close()
+        self._replicas = ()
+        self.database = None
+        self.user = None
+
+    def is_alive(self):
+        """ Check whether the server answers on the connection of the current thread.
+        In pooled mode a connection is checked out for the check, if the thread has none. """
+        try:
+            if self._pool is not None and getattr(self._local, 'connection', None) is None:
+                connection = self._pool.getconn()
+                try:
+                    return self._ping(connection)
+                finally:
+                    self._pool.putconn(connection)
+
+            return self._ping(self._get_connection())
+        except OperationalError:
+            return False
+
+    def get_pool_stats(self):
+        if self._pool is None:
+            return None
+        return self._pool.get_stats()
+
+    def get_replicas_stats(self):
+        return [
+            {
+                'latency': replica.latency,
+                'lag': replica.lag,
+                'available': replica.is_available(self.max_replica_lag, self.replica_check_interval),
+                'pool': replica.pool.get_stats(),
+            }
+            for replica in self._replicas
+        ]
+
+    def add_hook(self, hook):
+        self._hooks = self._hooks + (hook,)
+
+    def remove_hook(self, hook):
+        self._hooks = tuple(
+            registered_hook
+            for registered_hook in self._hooks
+            if registered_hook is not hook
+        )
+
+    @contextmanager
+    def transaction(self):
+        """ Run the block in a transaction, which is committed on success and rolled back on error.
+        Nested blocks use savepoints, so an error inside of them rolls back only the nested block.
+        In pooled mode the connection is returned to the pool when the outermost block exits. """
+        depth = getattr(self._local, 'transaction_depth', 0)
+        self._local.transaction_depth = depth + 1
+
+        if depth == 0:
+            try:
+                yield self
+            except BaseException:
+                self._local.transaction_depth = depth
+                self.rollback()
+                raise
+
+            self._local.transaction_depth = depth
+            self.commit()
+            return
+
+        savepoint = 'database_savepoint_{}'.format(depth)
+        try:
+            self.execute(Query('SAVEPOINT {}'.format(savepoint)))
+            yield self
+        except BaseException:
+            self._local.transaction_depth = depth
+            self.execute(Query('ROLLBACK TO SAVEPOINT {}'.format(savepoint)))
+            raise
+
+        self._local.transaction_depth = depth
+        self.execute(Query('RELEASE SAVEPOINT {}'.format(savepoint)))
+
+    @contextmanager
+    def unit_of_work(self, page_size=None):
+        """ Run the block in a transaction with a `UnitOfWork`, which is flushed before the commit.
+        Instances of models with `primary_key` and `__tablename__` are tracked when their attributes are
+        assigned, so they may be simply changed. Values changed in place should be preceded by `add`. """
+        with self.transaction():
+            previous = getattr(self._local, 'unit_of_work', None)
+            unit_of_work = self._local.unit_of_work = UnitOfWork(page_size=page_size)
+            try:
+                yield unit_of_work
+                unit_of_work.flush()
+            finally:
+                self._local.unit_of_work = previous
+
+    def get_unit_of_work(self):
+        return getattr(self._local, 'unit_of_work', None)
+
+    def get_cursors_report(self):
+        """ Return number of open and leaked cursors with stacks where they were created,
+        only cursors created in `debug_cursors` mode are tracked. """
+        with self._cursors_lock:
+            return {
+                'open': len(self._open_cursors),
+                'open_created_at': list(self._open_cursors.values()),
+                'leaked': self._leaked_cursors_count,
+                'leaked_created_at': list(self._leaked_cursors),
+            }
+
+    def get_prepared_statements_stats(self):
+        if self._prepared_statements is None:
+            return None
+        return dict(self._prepared_statements_stats)
+
     def commit(self):
-        self._get_connection().commit()
+        if self._pool is None:
+            self._get_connection().commit()
+            self._end_shared_transaction()
+            return
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            try:
+                connection.commit()
+            finally:
+                self._release_connection()
 
     def rollback(self):
-        if self._connection is not None:
-            self._connection.rollback()
+        if self._pool is None:
+            if self._connection is not None:
+                if self._connection.closed:
+                    # Transaction is gone with the connection, the next query opens a new one
+                    self._connection = None
+                else:
+                    self._connection.rollback()
+            self._end_shared_transaction()
+            return
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            try:
+                if not connection.closed:
+                    connection.rollback()
+            finally:
+                self._release_connection()
 
     def execute(self, query):
-        return self._get_cursor_for_query(query)
+        """ Execute query and return number of affected rows. """
+        with self._call_scope(), self._get_cursor() as cursor:
+            self._run_query(cursor, query)
+            return cursor.rowcount
+
+    def get_one(self, query, row_format='dict'):
+        with self._call_scope():
+            rows = self._get_rows(query, fetch='one', row_format=row_format)
+
+        if not rows:
+            return None
+
+        return rows[0]
+
+    def get_all(self, query, row_format='dict', cache_tags=None):
+        cache = self._result_cache
+        if cache is None or cache_tags is None:
+            with self._call_scope():
+                return self._get_rows(query, fetch='all', row_format=row_format)
+
+        try:
+            key = (query.query_string, _freeze(query.args), row_format)
+            hash(key)
+        except TypeError:
+            # Arguments of unknown types can not be a part of the key
+            with self._call_scope():
+                return self._get_rows(query, fetch='all', row_format=row_format)
+
+        cache_tags = tuple(cache_tags)
+        rows = cache.get(key)
+        if rows is None:
+            generations = cache.get_generations(cache_tags)
+            with self._call_scope():
+                # Rows may include uncommitted changes of the transaction, which could be rolled back
+                cacheable = not self._has_writes()
+                rows = self._get_rows(query, fetch='all', row_format=row_format)
+            if cacheable:
+                cache.set(key, rows, tags=cache_tags, generations=generations)
+
+        # Cached rows are shared between threads, so callers get their own list and dicts
+        if row_format == 'dict':
+            return [dict(row) for row in rows]
+        return list(rows)
+
+    def enable_result_cache(self, ttl=60, max_bytes=64 * 1024 * 1024):
+        self._result_cache = ResultCache(ttl=ttl, max_bytes=max_bytes)
+
+    def disable_result_cache(self):
+        self._result_cache = None
+
+    def invalidate_cached_results(self, tags):
+        cache = self._result_cache
+        if cache is not None:
+            cache.invalidate(tags)
+
+    def get_result_cache_stats(self):
+        cache = self._result_cache
+        if cache is None:
+            return None
+        return cache.get_stats()
+
+    def execute_batch(self, queries, page_size=None, row_format='dict'):
+        """ Execute queries sending up to `page_size` of them joined in one round trip.
+        PostgreSQL returns rows only for the last statement of a round trip, so a round trip is also ended
+        by every query which returns rows. Returns a list with rows of such queries and None for others. """
+        if page_size is None:
+            page_size = self.batch_page_size
+
+        results = []
+        statements = []
+        with self._call_scope(), self._get_cursor() as cursor:
+            for index, query in enumerate(queries):
+                self._mark_writes(query)
+                statements.append(cursor.mogrify(query.query_string, *query.args))
+                returns_rows = _RETURNS_ROWS_RE.match(query.query_string) is not None
+                results.append(None)
+
+                if returns_rows or len(statements) >= page_size:
+                    cursor.execute(b';'.join(statements))
+                    statements = []
+
+                    if returns_rows and cursor.description is not None:
+                        results[index] = self._format_rows(
+                            rows=cursor.fetchall(),
+                            names=self._get_column_names_from_cursor(cursor),
+                            row_format=row_format,
+                        )
+
+            if statements:
+                cursor.execute(b';'.join(statements))
+
+        return results
+
+    def get_column_names(self, query):
+        """ Return names of columns produced by a SELECT query without fetching its rows. """
+        with self._call_scope(), self._get_cursor() as cursor:
+            cursor.execute('SELECT * FROM ({}) AS query LIMIT 0'.format(query.query_string.rstrip().rstrip(';')),
+                           *query.args)
+            return list(self._get_column_names_from_cursor(cursor))
+
+    def get_all_values(self, query, values, page_size=None, row_format='dict'):
+        """ Run query with a single `VALUES %s` placeholder for all rows in `values` and return the produced rows.
+        Rows are sent in multi-row statements of `page_size` rows each, so there is one round trip per page. """
+        if query.args:
+            raise ValueError('Arguments are not supported for multi-row query: {}'.format(query.query_string))
+        if page_size is None:
+            page_size = self.values_page_size
+
+        with self._call_scope(), self._get_cursor() as cursor:
+            self._mark_writes(query)
+            rows = execute_values(cursor, query.query_string, values, page_size=page_size, fetch=True)
+            if not rows:
+                return []
+
+            return self._format_rows(
+                rows=rows,
+                names=self._get_column_names_from_cursor(cursor),
+                row_format=row_format,
+            )
 
-    def get_one(self, query):
-        cursor = self._get_cursor_for_query(query)
-        row = cursor.fetchone()
+    def get_iter(self, query, batch_size=None, row_format='dict'):
+        """ Lazily yield rows of the query fetched from a server-side cursor in batches of `batch_size`.
+        The cursor lives inside the current transaction, so it must be consumed before `commit` or `rollback`.
+        In pooled mode outside of `transaction` blocks the connection is held until iteration is over. """
+        if batch_size is None:
+            batch_size = self.iter_batch_size
+
+        with self._call_scope(), self._get_cursor(name='database_iter_{}'.format(next(self._cursor_names))) as cursor:
+            self._mark_writes(query)
+            cursor.execute(query.query_string, *query.args)
+
+            names = None
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                if names is None:
+                    names = self._get_column_names_from_cursor(cursor)
+
+                for row in self._format_rows(rows=rows, names=names, row_format=row_format):
+                    yield row
+
+    @contextmanager
+    def _call_scope(self):
+        """ In pooled mode a call made outside of `transaction` blocks, while the thread holds no connection,
+        is committed (or rolled back on error) and returns its connection to the pool when it is done. """
+        if (self._pool is None or getattr(self._local, 'transaction_depth', 0)
+                or getattr(self._local, 'connection', None) is not None):
+            yield
+            return
+
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _connect(self):
+        """ Open a new connection, retrying with exponential backoff while the server is unavailable. """
+        delay = self.reconnect_delay
+        for attempt in range(self.reconnect_attempts):
+            try:
+                return connect(**self._connection_params)
+            except OperationalError:
+                if attempt + 1 >= self.reconnect_attempts:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
 
-        if row is None:
-            return row
+    def _get_connection(self):
+        if self._pool is not None:
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None and connection.closed:
+                self._check_lost_connection(connection)
+                self._discard_connection(connection)
+                connection = None
+            if connection is None:
+                connection = self._local.connection = self._pool.getconn()
+            return connection
+
+        connection = self._connection
+        if connection is None or connection.closed:
+            if self.database is None:
+                raise RuntimeError('No database connection')
+            connection = self._reconnect(connection)
+
+        return connection
+
+    def _reconnect(self, connection):
+        with self._reconnect_lock:
+            if self._connection is not connection:
+                # Another thread has already replaced the connection
+                return self._connection
+
+            if connection is not None:
+                self._check_lost_connection(connection)
+            self._connection = self._connect()
+            self._end_shared_transaction()
+            self.reconnects += 1
+            return self._connection
+
+    @staticmethod
+    def _check_lost_connection(connection):
+        if connection.status != STATUS_READY:
+            raise OperationalError('Connection was lost in the middle of a transaction, it should be rolled back')
+
+    def _discard_connection(self, connection):
+        """ Drop the broken connection of the current thread along with idle pooled connections,
+        which are most likely broken by the same server restart. """
+        if self._pool is None:
+            with self._reconnect_lock:
+                if self._connection is connection:
+                    self._connection = None
+            return
+
+        self._release_connection(close=True)
+        self._pool.closeall()
+        self.reconnects += 1
+
+    def _ping(self, connection):
+        idle = connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if idle:
+            connection.rollback()
+        return True
+
+    def _release_connection(self, close=False):
+        connection = self._local.connection
+        self._local.connection = None
+        self._local.has_writes = False
+        self._pool.putconn(connection, close=close)
+
+    def _get_rows(self, query, fetch, row_format):
+        replica = self._choose_replica(query)
+        if replica is not None:
+            try:
+                return self._get_rows_from_replica(replica, query, fetch, row_format)
+            except OperationalError:
+                # Reading is safe to repeat on the primary
+                replica.mark_unavailable(self.replica_check_interval)
+
+        # Reading outside of a transaction is safe to repeat, if the connection was lost
+        retry = isinstance(query, ReadQuery) and not self._in_transaction()
+        try:
+            return self._get_rows_with_cursor(self._get_cursor(), query, fetch, row_format)
+        except OperationalError:
+            connection = self._get_connection_of_thread()
+            if not retry or connection is None or not connection.closed:
+                raise
+
+        self._discard_connection(connection)
+        self.retried_queries += 1
+        return self._get_rows_with_cursor(self._get_cursor(), query, fetch, row_format)
+
+    def _get_rows_from_replica(self, replica, query, fetch, row_format):
+        connection = replica.pool.getconn()
+        try:
+            started = _clock()
+            rows = self._get_rows_with_cursor(self._get_cursor(connection=connection), query, fetch, row_format)
+            replica.record_latency(_clock() - started)
+            return rows
+        finally:
+            replica.pool.putconn(connection)
+
+    def _get_rows_with_cursor(self, cursor, query, fetch, row_format):
+        with cursor:
+            rows = self._run_query(cursor, query, fetch=fetch)
+
+            if not rows:
+                return []
+
+            return self._format_rows(
+                rows=rows,
+                names=self._get_column_names_from_cursor(cursor),
+                row_format=row_format,
+            )
 
-        return self._populate_rows_with_names(
-            rows=[row],
-            names=self._get_column_names_from_cursor(cursor)
-        )[0]
+    def _choose_replica(self, query):
+        if not self._replicas or not isinstance(query, ReadQuery):
+            return None
+        if getattr(self._local, 'transaction_depth', 0) or self._thread_has_writes():
+            return None
 
-    def get_all(self, query):
-        cursor = self._get_cursor_for_query(query)
+        replicas = [
+            replica
+            for replica in self._replicas
+            if replica.is_available(self.max_replica_lag, self.replica_check_interval)
+        ]
+        if not replicas:
+            return None
+
+        if self.replica_selection == 'least_latency':
+            return min(replicas, key=lambda replica: replica.latency or 0.0)
+        return replicas[next(self._replica_numbers) % len(replicas)]
+
+    def _in_transaction(self):
+        """ Whether the connection used by the current thread is in a transaction. """
+        if getattr(self._local, 'transaction_depth', 0):
+            return True
+
+        connection = self._get_connection_of_thread()
+        if connection is None:
+            return False
+        if connection.closed:
+            return connection.status != STATUS_READY
+        return connection.get_transaction_status() != TRANSACTION_STATUS_IDLE
+
+    def _mark_writes(self, query):
+        """ Remember that the transaction may have uncommitted changes, unless the query only reads. """
+        if isinstance(query, ReadQuery) or _TRANSACTION_CONTROL_RE.match(query.query_string):
+            return
+        if self._pool is not None:
+            self._local.has_writes = True
+        else:
+            self._connection_has_writes = True
+            self._local.writes_transaction_number = self._transaction_number
+
+    def _has_writes(self):
+        """ Whether the transaction used by the current thread may have uncommitted changes.
+        In single connection mode it is the transaction shared by all threads. """
+        if self._pool is not None:
+            return getattr(self._local, 'has_writes', False)
+        return self._connection_has_writes
+
+    def _thread_has_writes(self):
+        """ Whether the current thread itself made uncommitted changes, which replicas do not see. """
+        if self._pool is not None:
+            return getattr(self._local, 'has_writes', False)
+        return getattr(self._local, 'writes_transaction_number', None) == self._transaction_number
+
+    def _end_shared_transaction(self):
+        self._connection_has_writes = False
+        self._transaction_number += 1
+
+    def _get_connection_of_thread(self):
+        if self._pool is not None:
+            return getattr(self._local, 'connection', None)
+        return self._connection
 
-        return self._populate_rows_with_names(
-            rows=cursor.fetchall(),
-            names=self._get_column_names_from_cursor(cursor)
+    def _run_query(self, cursor, query, fetch=None):
+        """ Execute query with the cursor and return 'one' or 'all' of its rows, if `fetch` is set. """
+        self._mark_writes(query)
+        if not self._hooks:
+            self._execute_query(cursor, query)
+            return self._fetch_rows(cursor, fetch)
+
+        started = _clock()
+        self._execute_query(cursor, query)
+        executed = _clock()
+        rows = self._fetch_rows(cursor, fetch)
+        fetched = _clock()
+
+        record = QueryRecord(
+            query_string=' '.join(query.query_string.split()),
+            execute_time=executed - started,
+            fetch_time=fetched - executed,
+            row_count=cursor.rowcount if rows is None else len(rows),
+            result_bytes=0 if rows is None else _estimate_size(rows),
         )
+        for hook in self._hooks:
+            hook(record)
 
-    def _get_connection(self):
-        if self._connection is None:
-            raise RuntimeError('No database connection')
+        return rows
 
-        return self._connection
+    def _fetch_rows(self, cursor, fetch):
+        if fetch == 'one':
+            return cursor.fetchmany(1)
+        if fetch == 'all':
+            return cursor.fetchall()
+        return None
+
+    def _get_cursor(self, name=None, connection=None):
+        if connection is None:
+            connection = self._get_connection()
 
-    def _get_cursor_for_query(self, query):
-        cursor = self._get_connection().cursor()
-        cursor.execute(query.query_string, *query.args)
-        return cursor
+        if self.debug_cursors:
+            return connection.cursor(name=name, cursor_factory=TrackedCursor)
+        return connection.cursor(name=name)
+
+    def _execute_query(self, cursor, query):
+        if self.prepare_cache_size:
+            self._get_prepared_statements(cursor.connection).execute(cursor, query)
+        else:
+            cursor.execute(query.query_string, *query.args)
+
+    def _track_cursor(self, cursor):
+        with self._cursors_lock:
+            self._open_cursors[id(cursor)] = cursor.created_at
+
+    def _untrack_cursor(self, cursor, leaked):
+        with self._cursors_lock:
+            if self._open_cursors.pop(id(cursor), None) is not None and leaked:
+                self._leaked_cursors.append(cursor.created_at)
+                self._leaked_cursors_count += 1
+
+    def _get_prepared_statements(self, connection):
+        with self._prepared_statements_lock:
+            prepared_statements = self._prepared_statements.get(connection)
+            if prepared_statements is None:
+                prepared_statements = self._prepared_statements[connection] = PreparedStatementCache(
+                    size=self.prepare_cache_size,
+                    threshold=self.prepare_threshold,
+                    stats=self._prepared_statements_stats,
+                )
+            return prepared_statements
 
     def _get_column_names_from_cursor(self, cursor):
-        return [column.name for column in cursor.description]
+        return tuple(column.name for column in cursor.description)
 
     def _populate_rows_with_names(self, rows, names):
-        named_rows = []
-        for row in rows:
-            named_rows.append({name: value
-                               for name, value in zip(names, row)})
-        return named_rows
+        return [dict(zip(names, row)) for row in rows]
+
+    def _format_rows(self, rows, names, row_format):
+        if row_format == 'dict':
+            return self._populate_rows_with_names(rows=rows, names=names)
+        if row_format == 'tuple':
+            return rows
+
+        layout = self._get_row_layout(names)
+        if row_format == 'namedtuple':
+            return list(map(layout.row_class._make, rows))
+        if isinstance(row_format, type) and issubclass(row_format, Object):
+            return row_format.from_rows(
+                names=layout.names,
+                rows=rows,
+                key_indexes=layout.get_key_indexes(row_format),
+            )
+
+        raise ValueError('Unknown row format: {!r}'.format(row_format))
+
+    def _get_row_layout(self, names):
+        """ Return cached layout for column names. Names are the whole cache key, so the layout of a query
+        changes together with its columns, e.g. after ALTER TABLE. """
+        layout = self._row_layouts.get(names)
+        if layout is None:
+            if len(self._row_layouts) >= self.row_layouts_cache_size:
+                self._row_layouts.clear()
+            layout = self._row_layouts[names] = RowLayout(names)
+        return layout
+
+
+class NotificationListener(threading.Thread):
+    """ Background thread which LISTENs to a channel on its own autocommit connection.
+    Payloads of received notifications are passed to `callback(connection, payloads)` in batches.
+
+    Errors do not stop the thread: a lost connection is opened again with exponential backoff. Notifications
+    sent meanwhile are lost, so after a reconnect or a failed callback `resync(connection)` is called
+    to reload everything which could have changed. """
+
+    poll_interval = 1.0
+
+    def __init__(self, channel, callback, resync=None):
+        super(NotificationListener, self).__init__(name='{}-listener'.format(channel))
+        self.daemon = True
+        self.channel = channel
+        self.callback = callback
+        self.resync = resync
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        connection = None
+        needs_resync = False
+        delay = Database().reconnect_delay
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    if connection is None:
+                        connection = self._listen()
+                    if needs_resync and self.resync is not None:
+                        self.resync(connection)
+                    needs_resync = False
+                    delay = Database().reconnect_delay
+
+                    self._receive(connection)
+                except Exception as error:
+                    self.errors += 1
+                    needs_resync = True
+                    warnings.warn('Notifications of {} channel may be lost: {}'.format(self.channel, error),
+                                  RuntimeWarning)
+                    if connection is not None and connection.closed:
+                        connection = None
+
+                    self._stop_event.wait(delay)
+                    delay = min(delay * 2, Database().max_reconnect_delay)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _listen(self):
+        connection = Database()._connect()
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(self.channel))
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def _receive(self, connection):
+        while not self._stop_event.is_set():
+            if select.select([connection], [], [], self.poll_interval) == ([], [], []):
+                continue
+
+            connection.poll()
+            payloads = []
+            while connection.notifies:
+                payloads.append(connection.notifies.pop(0).payload)
+
+            if payloads:
+                self.callback(connection, payloads)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
 
 
 class Options(Object):
-    """ This is an example model of key-value storage. """
+    """ This is an example model of key-value storage.
+    Reads of `get_option` can be cached in process with `enable_cache`, unless the transaction has uncommitted
+    changes. Writes made through this class invalidate cached entries. Changes made by other processes are picked up by
+    `start_listener`, if the trigger from `install_notify_trigger` sends their notifications. """
     primary_key = ('name',)
+    __tablename__ = 'options'
+    notify_channel = 'options_changes'
+
+    cache_tags = ('options',)
+
+    _cache = None
+    _not_cached = object()
+    _listener = None
+    _name_index_checked = False
+
+    @classmethod
+    def enable_cache(cls, ttl=60, max_size=1000):
+        cls._cache = TTLCache(ttl=ttl, max_size=max_size)
+
+    @classmethod
+    def disable_cache(cls):
+        cls._cache = None
+
+    @classmethod
+    def get_cache_stats(cls):
+        cache = cls._cache
+        if cache is None:
+            return None
+        return cache.get_stats()
+
+    @classmethod
+    def _invalidate_cache(cls, names=None):
+        """ Drop cached options with `names`, or all of them. """
+        cache = cls._cache
+        if cache is not None:
+            if names is None:
+                cache.clear()
+            else:
+                cache.invalidate(names)
+        Database().invalidate_cached_results(cls.cache_tags)
+
+    @classmethod
+    def _flushed(cls, objects):
+        cls._invalidate_cache([option.name for option in objects])
+
+    @classmethod
+    def install_notify_trigger(cls):
+        """ Make every committed change of options table send names of changed options to `notify_channel`. """
+        Database().execute(Query(
+            'CREATE OR REPLACE FUNCTION notify_options_changes() RETURNS trigger AS $$'
+            ' BEGIN'
+            "  IF TG_OP <> 'INSERT' THEN PERFORM pg_notify('{channel}', OLD.name); END IF;"
+            "  IF TG_OP <> 'DELETE' THEN PERFORM pg_notify('{channel}', NEW.name); END IF;"
+            '  RETURN NULL;'
+            ' END'
+            ' $$ LANGUAGE plpgsql'.format(channel=cls.notify_channel)
+        ))
+        Database().execute(Query('DROP TRIGGER IF EXISTS notify_options_changes ON options'))
+        Database().execute(Query(
+            'CREATE TRIGGER notify_options_changes AFTER INSERT OR UPDATE OR DELETE ON options'
+            ' FOR EACH ROW EXECUTE PROCEDURE notify_options_changes()'
+        ))
+
+    @classmethod
+    def start_listener(cls):
+        """ Start a background thread refreshing options changed by other processes. """
+        if cls._listener is not None:
+            raise RuntimeError('Options listener is already running')
+
+        cls._listener = NotificationListener(cls.notify_channel, cls._refresh_options, resync=cls._resync_options)
+        cls._listener.start()
+
+    @classmethod
+    def stop_listener(cls):
+        listener = cls._listener
+        if listener is not None:
+            cls._listener = None
+            listener.stop()
+
+    @classmethod
+    def _resync_options(cls, connection):
+        """ Drop all cached options and reload all mapped ones, since notifications about them could be lost. """
+        cls._invalidate_cache()
+        cls._refresh_options(connection, [key[0] for key in cls._get_instance_map().keys()])
+
+    @classmethod
+    def _refresh_options(cls, connection, names):
+        """ Reload mapped options with given names in place and forget the deleted ones. """
+        names = set(names)
+        cls._invalidate_cache(names)
+
+        instance_map = cls._get_instance_map()
+        mapped_names = [name for name in names if (name,) in instance_map]
+        if not mapped_names:
+            return
+
+        # Listener has its own connection, the one of `Database` may be in use by another thread
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT * FROM options WHERE name = ANY(%(names)s)', {'names': mapped_names})
+            refreshed_options = cls.from_rows(
+                names=[column.name for column in cursor.description],
+                rows=cursor.fetchall(),
+            )
+
+        for name in names.difference(option.name for option in refreshed_options):
+            instance_map.pop((name,), None)
 
     @classmethod
     def get_all_options(cls):
-        options_info = Database().get_all(
-            Query('SELECT * FROM options ORDER BY LOWER(name)')
+        return Database().get_all(
+            ReadQuery('SELECT * FROM options ORDER BY LOWER(name)'),
+            row_format=cls,
+            cache_tags=cls.cache_tags,
         )
-        return [cls(**option_info) for option_info in options_info]
+
+    @classmethod
+    def iter_all_options(cls, batch_size=None):
+        return Database().get_iter(
+            Query('SELECT * FROM options ORDER BY LOWER(name)'),
+            batch_size=batch_size,
+            row_format=cls,
+        )
+
+    @classmethod
+    def iter_options_pages(cls, page_size=1000):
+        """ Yield lists of at most `page_size` options in the order of `get_all_options`.
+        Every page continues right after the last option of the previous one (keyset pagination), so unlike
+        OFFSET each page costs the same, given there is an index on `(LOWER(name), name)`. """
+        cls.check_name_index()
+
+        last_option = None
+        while True:
+            if last_option is None:
+                query = ReadQuery(
+                    'SELECT * FROM options ORDER BY LOWER(name), name LIMIT %(limit)s',
+                    limit=page_size,
+                )
+            else:
+                query = ReadQuery(
+                    'SELECT * FROM options WHERE (LOWER(name), name) > (LOWER(%(name)s), %(name)s)'
+                    ' ORDER BY LOWER(name), name LIMIT %(limit)s',
+                    name=last_option.name,
+                    limit=page_size,
+                )
+
+            options = Database().get_all(query, row_format=cls)
+            if options:
+                yield options
+            if len(options) < page_size:
+                return
+
+            last_option = options[-1]
+
+    @classmethod
+    def check_name_index(cls):
+        """ Warn once if there is no index starting with `LOWER(name)`, which ordered queries rely on. """
+        if cls._name_index_checked:
+            return
+        cls._name_index_checked = True
+
+        index_definitions = Database().get_all(
+            ReadQuery("SELECT indexdef FROM pg_indexes WHERE tablename = 'options'"),
+            row_format='tuple',
+        )
+        if not any(re.search(r'USING \w+ \(lower\(name\)', index_definition, re.IGNORECASE)
+                   for index_definition, in index_definitions):
+            warnings.warn(
+                'There is no index on LOWER(name) of options table, ordered queries will scan the whole table.'
+                ' Create it with: CREATE INDEX options_lower_name_idx ON options (LOWER(name), name)'
+            )
 
     @classmethod
     def get_option(cls, name):
-        option_info = Database().get_one(
-            Query('SELECT * FROM options WHERE name = %(name)s', name=name)
+        cache = cls._cache
+        if cache is not None:
+            option = cache.get(name, cls._not_cached)
+            if option is not cls._not_cached:
+                return option
+
+        # Uncommitted changes of the transaction must not be seen by others
+        cacheable = cache is not None and not Database()._has_writes()
+
+        option = Database().get_one(
+            ReadQuery('SELECT * FROM options WHERE name = %(name)s', name=name),
+            row_format=cls,
         )
-        if option_info:
-            return cls(**option_info)
+
+        # Absence of an option is cached too, until it is added
+        if cacheable:
+            cache[name] = option
+        return option
+
+    @classmethod
+    def get_options(cls, names):
+        """ Return mapping of names to options in a single query.
+        Options already present in the identity map are not queried, missing options are absent from the result. """
+        options = {}
+        missing_names = []
+
+        instance_map = cls._get_instance_map()
+        for name in names:
+            option = instance_map.get((name,))
+            if option is None:
+                missing_names.append(name)
+            else:
+                options[name] = option
+
+        if missing_names:
+            found_options = Database().get_all(
+                ReadQuery('SELECT * FROM options WHERE name = ANY(%(names)s)', names=missing_names),
+                row_format=cls,
+            )
+            for option in found_options:
+                options[option.name] = option
+
+        return options
 
     @classmethod
     def add_option(cls, name, value):
@@ -199,9 +2202,43 @@ class Options(Object):
                 value=value,
             )
         )
+        cls._invalidate_cache([name])
         return cls(**option_info)
 
+    @classmethod
+    def add_options(cls, options, page_size=None):
+        """ Insert all (name, value) pairs from `options` using multi-row INSERTs and return created options. """
+        added_options = Database().get_all_values(
+            Query('INSERT INTO options (name, value) VALUES %s RETURNING *'),
+            values=options,
+            page_size=page_size,
+            row_format=cls,
+        )
+        cls._invalidate_cache([option.name for option in added_options])
+        return added_options
+
+    @classmethod
+    def set_many(cls, options, page_size=None):
+        """ Set values of all options from `options` mapping, adding missing ones, with batched upserts.
+        Options present in the identity map are updated in place. Returns the list of set options. """
+        set_options = Database().get_all_values(
+            Query(
+                'INSERT INTO options (name, value) VALUES %s'
+                ' ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value RETURNING *'
+            ),
+            values=options.items(),
+            page_size=page_size,
+            row_format=cls,
+        )
+        cls._invalidate_cache([option.name for option in set_options])
+        return set_options
+
     def update(self, value):
+        """ Set value of the option. In a unit of work the value is written when it is flushed. """
+        if Database().get_unit_of_work() is not None:
+            self.value = value
+            return
+
         option_info = Database().get_one(
             Query(
                 'UPDATE options SET value = %(value)s WHERE name = %(name)s RETURNING *',
@@ -209,23 +2246,26 @@ class Options(Object):
                 value=value,
             )
         )
+        self._invalidate_cache([self.name])
         super(Options, self).update(**option_info)
 
     @classmethod
     def create_demo_table(cls):
-        queries = [
+        Database().execute_batch([
             Query('CREATE TABLE options (name TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)'),
-            Query('INSERT INTO options (name, value) VALUES (%(name)s, %(value)s)', name='first', value='one'),
-            Query('INSERT INTO options (name, value) VALUES (%(name)s, %(value)s)', name='second', value='two'),
-            Query('INSERT INTO options (name, value) VALUES (%(name)s, %(value)s)', name='third', value='three'),
-            Query('INSERT INTO options (name, value) VALUES (%(name)s, %(value)s)', name='forth', value='four'),
-        ]
-        for query in queries:
-            Database().execute(query)
+            Query('CREATE INDEX options_lower_name_idx ON options (LOWER(name), name)'),
+        ])
+        cls.add_options([
+            ('first', 'one'),
+            ('second', 'two'),
+            ('third', 'three'),
+            ('forth', 'four'),
+        ])
 
     @classmethod
     def destroy_demo_table(cls):
         Database().execute(Query('DROP TABLE options'))
+        cls._invalidate_cache()
 
     def __repr__(self):
         return '<Option: name={name!r}, value={value!r}>'.format(
@@ -239,11 +2279,20 @@ class UserTablesStats(Object):
 
     @classmethod
     def get_stats(cls):
-        stats_info = Database().get_all(
+        return Database().get_all(
+            ReadQuery('SELECT schemaname AS schema, relname AS table,'
+                  ' seq_scan, idx_scan, now() as timestamp FROM pg_stat_user_tables'),
+            row_format=cls,
+        )
+
+    @classmethod
+    def iter_stats(cls, batch_size=None):
+        return Database().get_iter(
             Query('SELECT schemaname AS schema, relname AS table,'
-                  ' seq_scan, idx_scan, now() as timestamp FROM pg_stat_user_tables')
+                  ' seq_scan, idx_scan, now() as timestamp FROM pg_stat_user_tables'),
+            batch_size=batch_size,
+            row_format=cls,
         )
-        return [cls(**table_stats) for table_stats in stats_info]
 
     def __repr__(self):
         return (
@@ -257,6 +2306,117 @@ class UserTablesStats(Object):
             ))
 
 
+class UserTablesStatsSampler(threading.Thread):
+    """ Background thread taking snapshots of user tables scan counters every `interval` seconds.
+    The latest `capacity` snapshots are kept in a ring buffer: an array of snapshot timestamps and a pair
+    of arrays with sequential and index scan counters for every table, where -1 marks a missing value. """
+
+    def __init__(self, interval=60.0, capacity=60):
+        if capacity < 2:
+            raise ValueError('Sampler capacity should be at least 2, got {}'.format(capacity))
+
+        super(UserTablesStatsSampler, self).__init__(name='user-tables-stats-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.capacity = capacity
+
+        self._timestamps = array('d', [0.0] * capacity)
+        self._tables = {}
+        self._position = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # Statistics views return the same values until the end of transaction, so a fresh one is needed every time
+        connection = Database()._connect()
+        connection.autocommit = True
+        try:
+            while not self._stop_event.is_set():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT extract(epoch FROM now()), schemaname, relname, seq_scan, idx_scan'
+                                   ' FROM pg_stat_user_tables')
+                    self.add_snapshot(cursor.fetchall())
+                self._stop_event.wait(self.interval)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def add_snapshot(self, rows):
+        """ Store snapshot made of (timestamp, schema, table, seq_scan, idx_scan) rows. """
+        with self._lock:
+            position = self._position
+            self._timestamps[position] = rows[0][0] if rows else time.time()
+
+            # Tables missing from the whole buffer, e.g. dropped ones, are forgotten
+            for key, counters in list(self._tables.items()):
+                counters[0][position] = counters[1][position] = -1
+                if max(counters[0]) < 0 and max(counters[1]) < 0:
+                    del self._tables[key]
+
+            for _, schema, table, seq_scan, idx_scan in rows:
+                counters = self._tables.get((schema, table))
+                if counters is None:
+                    counters = self._tables[(schema, table)] = (
+                        array('d', [-1] * self.capacity),
+                        array('d', [-1] * self.capacity),
+                    )
+                counters[0][position] = -1 if seq_scan is None else seq_scan
+                counters[1][position] = -1 if idx_scan is None else idx_scan
+
+            self._position = (position + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def get_deltas(self, samples=1):
+        """ Return changes of scan counters and their per second rates between the latest snapshot and
+        the one taken `samples` snapshots before it, most sequentially scanned tables first. """
+        if not 0 < samples < self.capacity:
+            raise ValueError('Samples should be between 1 and {}, got {}'.format(self.capacity - 1, samples))
+
+        with self._lock:
+            if self._count <= samples:
+                return []
+
+            latest = (self._position - 1) % self.capacity
+            previous = (latest - samples) % self.capacity
+            elapsed = self._timestamps[latest] - self._timestamps[previous]
+
+            deltas = []
+            for (schema, table), (seq_scans, idx_scans) in self._tables.items():
+                if seq_scans[latest] < 0 and idx_scans[latest] < 0:
+                    continue
+
+                seq_scan = self._get_delta(seq_scans[previous], seq_scans[latest])
+                idx_scan = self._get_delta(idx_scans[previous], idx_scans[latest])
+                deltas.append({
+                    'schema': schema,
+                    'table': table,
+                    'interval': elapsed,
+                    'seq_scan': seq_scan,
+                    'idx_scan': idx_scan,
+                    'seq_scan_rate': None if seq_scan is None or not elapsed else seq_scan / elapsed,
+                    'idx_scan_rate': None if idx_scan is None or not elapsed else idx_scan / elapsed,
+                })
+
+        deltas.sort(key=lambda delta: delta['seq_scan_rate'] or 0, reverse=True)
+        return deltas
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _get_delta(previous, latest):
+        if previous < 0 or latest < 0:
+            return None
+        # Counters start over after statistics reset
+        if latest < previous:
+            return int(latest)
+        return int(latest - previous)
+
+
 Point = namedtuple('Point', ['x', 'y'])
 
 
@@ -264,6 +2424,7 @@ class RandomCoordinates(Object):
     """ Example model which does not require table. """
 
     primary_key = ('x', 'y')
+    identity_map_mode = 'weak'
 
     @classmethod
     def pick(cls, point1, point2):
@@ -273,7 +2434,7 @@ class RandomCoordinates(Object):
         max_y = max(point1.y, point2.y)
 
         coordinates_info = Database().get_one(
-            Query(
+            ReadQuery(
                 'SELECT'
                 ' (RANDOM() * %(width)s + %(min_x)s)::int AS x,'
                 ' (RANDOM() * %(height)s + %(min_y)s)::int AS y;',
@@ -286,6 +2447,55 @@ class RandomCoordinates(Object):
 
         return cls(**coordinates_info)
 
+    @classmethod
+    def pick_many(cls, point1, point2, count, distinct=False, batch_size=None):
+        """ Lazily yield `count` random coordinates generated by a single query.
+        If `distinct` is set, duplicate coordinates are yielded once, so there may be less than `count` of them. """
+        min_x = min(point1.x, point2.x)
+        min_y = min(point1.y, point2.y)
+        max_x = max(point1.x, point2.x)
+        max_y = max(point1.y, point2.y)
+
+        query_string = (
+            'SELECT'
+            ' (RANDOM() * %(width)s + %(min_x)s)::int AS x,'
+            ' (RANDOM() * %(height)s + %(min_y)s)::int AS y'
+            ' FROM generate_series(1, %(count)s)'
+        )
+        if distinct:
+            query_string = 'SELECT DISTINCT x, y FROM ({}) AS coordinates'.format(query_string)
+
+        return Database().get_iter(
+            Query(
+                query_string,
+                width=max_x - min_x,
+                height=max_y - min_y,
+                min_x=min_x,
+                min_y=min_y,
+                count=count,
+            ),
+            batch_size=batch_size,
+            row_format=cls,
+        )
+
+    @classmethod
+    def pick_local(cls, point1, point2, count, seed=None):
+        """ Generate `count` uniformly distributed coordinates in process, without a database.
+        Returns a pair of NumPy arrays of x and y. Values are rounded to the nearest integer, ties to even,
+        the same way PostgreSQL casts `RANDOM() * width + min` to int. Pass `seed` to get reproducible results. """
+        if numpy is None:
+            raise RuntimeError('NumPy package is required to generate coordinates locally')
+
+        min_x = min(point1.x, point2.x)
+        min_y = min(point1.y, point2.y)
+        max_x = max(point1.x, point2.x)
+        max_y = max(point1.y, point2.y)
+
+        generator = numpy.random.default_rng(seed)
+        x = numpy.rint(generator.random(count) * (max_x - min_x) + min_x).astype(numpy.int32)
+        y = numpy.rint(generator.random(count) * (max_y - min_y) + min_y).astype(numpy.int32)
+        return x, y
+
     def __repr__(self):
         return '<RandomCoordinates: x={x!r}, y={y!r}>'.format(x=self.x, y=self.y)
 
@@ -297,43 +2507,51 @@ def main(argv=None):
     # Connect to a database
     Database().initialize(user=DB_LOGIN, password=DB_PASSWORD, database=DB_NAME, host=DB_HOST, port=DB_PORT)
 
-    # Create and populate key-value storage
-    Options.create_demo_table()
+    # Everything below is committed at once, or rolled back on error
+    with Database().transaction():
+        # Create and populate key-value storage
+        Options.create_demo_table()
+
+        # Get an existing option
+        first_option = Options.get_option('first')
+        print(first_option)
+
+        # Create new option
+        fifth_option = Options.add_option(name='fifth', value='five')
+        print(fifth_option)
 
-    # Get an existing option
-    first_option = Options.get_option('first')
-    print(first_option)
+        # Adding of a duplicate option fails, but only the nested transaction is rolled back
+        try:
+            with Database().transaction():
+                Options.add_option(name='fifth', value='five again')
+        except IntegrityError:
+            print('Option {!r} already exists'.format(fifth_option.name))
 
-    # Create new option
-    fifth_option = Options.add_option(name='fifth', value='five')
-    print(fifth_option)
+        # Update existing option
+        first_option.update(value='The One')
+        print(first_option)
 
-    # Update existing option
-    first_option.update(value='The One')
-    print(first_option)
+        # List all available options
+        option = Options.get_all_options()
+        pprint(option)
 
-    # List all available options
-    option = Options.get_all_options()
-    pprint(option)
+        # Get user table usage statistics from PostgreSQL predefined view
+        stats = UserTablesStats.get_stats()
+        pprint(stats)
 
-    # Get user table usage statistics from PostgreSQL predefined view
-    stats = UserTablesStats.get_stats()
-    pprint(stats)
+        # Generate a random coordinate, and then 5 more in one query
+        coordinate = RandomCoordinates.pick(Point(x=-500, y=-500),
+                                            Point(x=500, y=500))
+        print(coordinate)
 
-    # Generate 5 random coordinates
-    coordinates = [
-        RandomCoordinates.pick(Point(x=-500, y=-500),
-                               Point(x=500, y=500))
-        for _ in range(5)
-    ]
-    pprint(coordinates)
+        coordinates = list(RandomCoordinates.pick_many(Point(x=-500, y=-500),
+                                                       Point(x=500, y=500),
+                                                       count=5))
+        pprint(coordinates)
 
-    # Drop previously created table
-    Options.destroy_demo_table()
+        # Drop previously created table
+        Options.destroy_demo_table()
 
 
 if __name__ == '__main__':
-    try:
-        sys.exit(main())
-    finally:
-        Database().rollback()
+    sys.exit(main())